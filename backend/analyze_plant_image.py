@@ -1,37 +1,172 @@
+import io
 import base64
+import asyncio
+import logging
 from groq import AsyncGroq
 import os
+from typing import AsyncIterator, Dict, List
 from dotenv import load_dotenv
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it images are sent as uploaded
+    Image = None
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
 
+VISION_MODEL = "llama-3.2-11b-vision-preview"
+MERGE_MODEL = "llama-3.1-8b-instant"
+ANALYSIS_PROMPT = "As a plant analysis expert, please analyze this plant image and provide:\n1. Plant identification\n2. Care tips\n3. Health assessment"
+# Vision calls allowed in flight per batch upload
+MAX_CONCURRENT_VISION = int(os.getenv("MAX_CONCURRENT_VISION", "4"))
+# The vision model accepts at most this many images in one request
+MAX_IMAGES_PER_REQUEST = 5
+# Longest image side sent to the model; phone photos are far larger than it needs
+MAX_IMAGE_SIDE = 1024
+
+def preprocess_image(image_bytes: bytes, max_side: int = MAX_IMAGE_SIDE) -> bytes:
+    """
+    Downscales and re-encodes an image as JPEG to cut upload size and vision latency.
+    Raises for images that are corrupt or too large to decode safely.
+    """
+    if Image is None:
+        return image_bytes
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+    except Image.UnidentifiedImageError:
+        # Let the vision model decide what to make of formats Pillow cannot read
+        return image_bytes
+    # Phone photos are often stored sideways with an EXIF orientation tag
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    image.thumbnail((max_side, max_side))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+def _image_content(image_bytes: bytes) -> Dict:
+    base64_image = base64.b64encode(image_bytes).decode('utf-8')
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
+    }
+
 async def analyze_plant_image(image_bytes):
     try:
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
-        
         completion = await client.chat.completions.create(
-            model="llama-3.2-11b-vision-preview",
+            model=VISION_MODEL,
             messages=[
                 {
                     "role": "user",
                     "content": [
                         {
                             "type": "text",
-                            "text": "As a plant analysis expert, please analyze this plant image and provide:\n1. Plant identification\n2. Care tips\n3. Health assessment"
+                            "text": ANALYSIS_PROMPT
                         },
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-                        }
+                        _image_content(image_bytes)
                     ]
                 }
             ]
         )
-        
+
         return completion.choices[0].message.content
-        
+
     except Exception as e:
         print(f"Error in analyze_plant_image: {e}")
-        raise
\ No newline at end of file
+        raise
+
+async def analyze_plant_images_packed(images: List[bytes]) -> str:
+    """Analyzes several shots of the same plant in a single vision request."""
+    try:
+        completion = await client.chat.completions.create(
+            model=VISION_MODEL,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": f"These {len(images)} images show the same plant from different angles. {ANALYSIS_PROMPT}"
+                        },
+                        *[_image_content(image_bytes) for image_bytes in images]
+                    ]
+                }
+            ]
+        )
+
+        return completion.choices[0].message.content
+
+    except Exception as e:
+        logger.error(f"Error in analyze_plant_images_packed: {e}")
+        raise
+
+async def merge_diagnoses(analyses: List[str]) -> str:
+    """Combines per-image analyses of one plant into a single diagnosis."""
+    if len(analyses) == 1:
+        return analyses[0]
+    sections = "\n\n".join(f"Image {i + 1}:\n{analysis}" for i, analysis in enumerate(analyses))
+    completion = await client.chat.completions.create(
+        model=MERGE_MODEL,
+        messages=[
+            {
+                "role": "user",
+                "content": "The following analyses describe different photos of the same plant. Merge them into one "
+                           "analysis with plant identification, care tips and health assessment, resolving any "
+                           f"disagreements:\n\n{sections}"
+            }
+        ],
+        temperature=0.3,
+        max_tokens=800
+    )
+    return completion.choices[0].message.content
+
+async def analyze_plant_images(images: List[bytes], mode: str = "fanout") -> AsyncIterator[Dict]:
+    """
+    Analyzes several images of one plant and yields events as they become available:
+    one "image" (or "error") event per image in fan-out mode, then a final "summary".
+    """
+    async def prepare(index: int, image_bytes: bytes):
+        try:
+            return index, await asyncio.to_thread(preprocess_image, image_bytes), None
+        except Exception as e:
+            # Includes Image.DecompressionBombError, which is not an OSError
+            logger.warning(f"Could not preprocess image {index}: {e}")
+            return index, None, str(e)
+
+    # Decoding and resizing is CPU-bound, so run it on worker threads in parallel
+    processed: Dict[int, bytes] = {}
+    for index, image_bytes, error in await asyncio.gather(*[prepare(i, image) for i, image in enumerate(images)]):
+        if error is not None:
+            yield {"type": "error", "index": index, "error": error}
+        else:
+            processed[index] = image_bytes
+    if not processed:
+        return
+
+    if mode == "packed" and len(processed) <= MAX_IMAGES_PER_REQUEST:
+        yield {"type": "summary", "analysis": await analyze_plant_images_packed(list(processed.values()))}
+        return
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_VISION)
+
+    async def analyze(index: int, image_bytes: bytes):
+        async with semaphore:
+            try:
+                return index, await analyze_plant_image(image_bytes), None
+            except Exception as e:
+                return index, None, str(e)
+
+    analyses: Dict[int, str] = {}
+    for finished in asyncio.as_completed([analyze(i, image) for i, image in processed.items()]):
+        index, analysis, error = await finished
+        if error is not None:
+            yield {"type": "error", "index": index, "error": error}
+            continue
+        analyses[index] = analysis
+        yield {"type": "image", "index": index, "analysis": analysis}
+
+    if analyses:
+        yield {"type": "summary", "analysis": await merge_diagnoses([analyses[i] for i in sorted(analyses)])}
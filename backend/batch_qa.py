@@ -0,0 +1,208 @@
+import os
+import csv
+import json
+import time
+import asyncio
+import argparse
+import logging
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Set
+from rag import embedding_model
+from knowledge_base import RELEVANCE_MAX_DISTANCE, load_current_snapshot
+from updated_rag_without_sentence_transfromers import FOLLOWUP_MODE, custom_query_with_groq
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1.0):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+def read_questions(path: str) -> Iterator[Dict[str, str]]:
+    """Streams {"id", "question"} records from a CSV or JSONL file."""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            rows: Iterator[Dict] = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for line_number, row in enumerate(rows):
+            question = (row.get("question") or "").strip()
+            if question:
+                row_id = row.get("id")
+                yield {"id": str(line_number if row_id in (None, "") else row_id), "question": question}
+
+def compact_output(output_path: str) -> Set[str]:
+    """
+    Prepares the output of a previous run for resuming and returns the IDs already answered.
+    Failed questions are retried, so their error records are dropped here along with any
+    partially written line and duplicate answers, leaving one record per ID.
+    """
+    done: Set[str] = set()
+    if not os.path.exists(output_path):
+        return done
+    kept: List[str] = []
+    dropped = 0
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash can leave a partially written last line
+                dropped += 1
+                continue
+            if "error" in record or record["id"] in done:
+                dropped += 1
+                continue
+            done.add(record["id"])
+            kept.append(line if line.endswith("\n") else line + "\n")
+
+    if dropped:
+        # os.replace is atomic, so a crash here leaves either the old or the compacted file
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(kept)
+        os.replace(tmp_path, output_path)
+        logger.info(f"Dropped {dropped} failed or incomplete records from {output_path}")
+    return done
+
+def batched(items: Iterator[Dict[str, str]], size: int) -> Iterator[List[Dict[str, str]]]:
+    batch: List[Dict[str, str]] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def answer_question(item: Dict[str, str], chunk_ids: List[int], all_chunks: List[str], followup_engine,
+                          semaphore: asyncio.Semaphore, bucket: TokenBucket,
+                          query_embedding: Optional[np.ndarray] = None) -> Dict:
+    # The answer is one LLM request; follow-ups are a second one unless they come from the question bank
+    calls = 1 if followup_engine is not None and FOLLOWUP_MODE == "local" else 2
+    async with semaphore:
+        await bucket.acquire(calls)
+        started = time.perf_counter()
+        try:
+            response, followups = await custom_query_with_groq(
+                item["question"], [all_chunks[i] for i in chunk_ids], None, followup_engine, chunk_ids,
+                query_embedding=query_embedding
+            )
+            result = {"response": response, "followups": followups}
+        except Exception as e:
+            logger.error(f"Error answering question {item['id']}: {e}")
+            result = {"error": str(e)}
+    result.update({
+        "id": item["id"],
+        "question": item["question"],
+        "chunk_ids": chunk_ids,
+        "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+    })
+    return result
+
+async def run_batch(input_path: str, output_path: str, batch_size: int = 64, concurrency: int = 8,
+                    requests_per_minute: float = 30, top_k: int = 5, relevance_threshold: float = RELEVANCE_MAX_DISTANCE,
+                    limit: Optional[int] = None):
+    # Answer from the same snapshot the server is serving, so results match production
+    snapshot = load_current_snapshot(encoder=embedding_model)
+    index, all_chunks, followup_engine = snapshot.index, snapshot.chunks, snapshot.followup_engine
+    logger.info(f"Answering against knowledge base snapshot {snapshot.version}")
+
+    done = compact_output(output_path)
+    if done:
+        logger.info(f"Resuming: skipping {len(done)} questions already answered")
+    pending = (item for item in read_questions(input_path) if item["id"] not in done)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    # Capacity must cover the two requests a question can cost, even with a concurrency of one
+    bucket = TokenBucket(rate=requests_per_minute / 60.0, capacity=max(2.0, concurrency))
+    answered = 0
+    submitted = 0
+    started = time.perf_counter()
+    in_flight: Set[asyncio.Task] = set()
+
+    with open(output_path, "a", encoding="utf-8") as out:
+        async def drain(max_in_flight: int):
+            """Writes finished answers until at most max_in_flight questions are still running."""
+            nonlocal answered
+            while len(in_flight) > max_in_flight:
+                finished, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    in_flight.remove(task)
+                    out.write(json.dumps(task.result()) + "\n")
+                    answered += 1
+                out.flush()
+
+        for batch in batched(pending, batch_size):
+            if limit is not None:
+                batch = batch[:max(0, limit - submitted)]
+                if not batch:
+                    break
+
+            # One encoder call and one FAISS search for the whole batch. Encoding runs on a worker
+            # thread so the previous batch's LLM calls keep going meanwhile
+            embeddings = np.asarray(
+                await asyncio.to_thread(embedding_model.encode, [item["question"] for item in batch], batch_size=batch_size),
+                dtype=np.float32
+            )
+            distances, indices = index.search(embeddings, top_k)
+
+            for row, item in enumerate(batch):
+                chunk_ids = []
+                if distances[row][0] <= relevance_threshold:
+                    chunk_ids = [int(i) for i in indices[row] if 0 <= i < len(all_chunks)]
+                in_flight.add(asyncio.create_task(
+                    answer_question(item, chunk_ids, all_chunks, followup_engine, semaphore, bucket, embeddings[row])
+                ))
+            submitted += len(batch)
+
+            # Prepare the next batch once this many are left, rather than waiting for the slowest
+            # answer, so the semaphore never runs dry between batches
+            await drain(max(batch_size, concurrency))
+            elapsed = time.perf_counter() - started
+            logger.info(f"Answered {answered} questions in {elapsed:.1f}s ({answered / elapsed:.2f}/s)")
+
+        await drain(0)
+        elapsed = time.perf_counter() - started
+        logger.info(f"Answered {answered} questions in {elapsed:.1f}s ({answered / elapsed:.2f}/s)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a file of questions against the knowledge base.")
+    parser.add_argument("input", help="CSV or JSONL file with a 'question' field and optional 'id'")
+    parser.add_argument("output", help="JSONL file to append answers to; existing answers are skipped and failed ones retried")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rpm", type=float, default=30, help="Maximum LLM requests per minute, follow-up calls included")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    asyncio.run(run_batch(
+        args.input, args.output,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        top_k=args.top_k,
+        limit=args.limit,
+    ))
+
+if __name__ == "__main__":
+    main()
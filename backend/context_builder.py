@@ -0,0 +1,116 @@
+import os
+import re
+import hashlib
+import logging
+import numpy as np
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from lexical import hash_embed, tokenize
+
+logger = logging.getLogger(__name__)
+
+# Token budgets for the retrieved context and the replayed conversation history
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "600"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "800"))
+# Sentences whose SimHash fingerprints differ in at most this many bits are treated as duplicates
+SIMHASH_DISTANCE = 3
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+@dataclass
+class ContextStats:
+    tokens_before: int
+    tokens_after: int
+    sentences_before: int
+    sentences_after: int
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count; Llama tokenizers average about four characters per token."""
+    return (len(text) + 3) // 4
+
+def merge_adjacent_chunks(chunks: List[Tuple[int, str]]) -> List[str]:
+    """
+    Joins hits with consecutive chunk IDs back into one passage.
+    Chunks are fixed-size slices of the same text, so adjacent ones continue each other.
+    """
+    passages: List[str] = []
+    last_id: Optional[int] = None
+    for chunk_id, text in sorted(chunks):
+        if last_id is not None and chunk_id == last_id + 1:
+            passages[-1] += text
+        elif last_id is None or chunk_id != last_id:
+            passages.append(text)
+        last_id = chunk_id
+    return passages
+
+def split_sentences(text: str) -> List[str]:
+    # PDF extraction wraps lines mid-sentence and hyphenates words across lines
+    text = re.sub(r"-\n", "", text)
+    text = re.sub(r"\s*\n\s*", " ", text)
+    return [s.strip() for s in SENTENCE_BOUNDARY.split(text) if s.strip()]
+
+def simhash(text: str) -> int:
+    weights = [0] * 64
+    for token in tokenize(text):
+        h = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def deduplicate_sentences(sentences: List[str]) -> List[str]:
+    kept: List[str] = []
+    fingerprints: List[int] = []
+    for sentence in sentences:
+        fingerprint = simhash(sentence)
+        if any(bin(fingerprint ^ other).count("1") <= SIMHASH_DISTANCE for other in fingerprints):
+            continue
+        kept.append(sentence)
+        fingerprints.append(fingerprint)
+    return kept
+
+def compress_sentences(query: str, sentences: List[str], token_budget: int) -> List[str]:
+    """Keeps the sentences most similar to the query that fit the budget, in their original order."""
+    if not sentences:
+        return []
+    vectors = hash_embed([query] + sentences)
+    scores = vectors[1:] @ vectors[0]
+
+    chosen = set()
+    used = 0
+    for i in np.argsort(-scores, kind="stable"):
+        cost = estimate_tokens(sentences[i])
+        if used + cost > token_budget:
+            continue
+        chosen.add(int(i))
+        used += cost
+    return [sentences[i] for i in sorted(chosen)]
+
+def build_context(query: str, chunks: List[Tuple[int, str]],
+                  token_budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[str, ContextStats]:
+    """Merges, deduplicates and compresses retrieved chunks into a single context string."""
+    raw = "\n".join(text for _, text in chunks)
+    passages = merge_adjacent_chunks(chunks)
+    sentences = [s for passage in passages for s in split_sentences(passage)]
+    unique = deduplicate_sentences(sentences)
+    selected = compress_sentences(query, unique, token_budget)
+    context = " ".join(selected)
+    stats = ContextStats(
+        tokens_before=estimate_tokens(raw),
+        tokens_after=estimate_tokens(context),
+        sentences_before=len(sentences),
+        sentences_after=len(selected),
+    )
+    return context, stats
+
+def trim_history(history: List[Dict[str, str]], token_budget: int = HISTORY_TOKEN_BUDGET) -> List[Dict[str, str]]:
+    """Keeps the most recent turns that fit the budget."""
+    trimmed: List[Dict[str, str]] = []
+    used = 0
+    for message in reversed(history):
+        cost = estimate_tokens(message["content"])
+        if used + cost > token_budget:
+            break
+        trimmed.append(message)
+        used += cost
+    trimmed.reverse()
+    return trimmed
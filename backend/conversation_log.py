@@ -0,0 +1,147 @@
+import os
+import json
+import gzip
+import time
+import asyncio
+import sqlite3
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# "sqlite", "jsonl" (gzip-compressed, append-only) or "off"
+CONVERSATION_LOG = os.getenv("CONVERSATION_LOG", "sqlite")
+CONVERSATION_LOG_PATH = os.getenv("CONVERSATION_LOG_PATH", "conversations.db" if CONVERSATION_LOG == "sqlite" else "conversations.jsonl.gz")
+# Turns waiting to be written; beyond this new turns are dropped rather than slowing responses
+MAX_QUEUE_SIZE = int(os.getenv("CONVERSATION_LOG_QUEUE", "10000"))
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 1.0  # seconds
+
+TURN_COLUMNS = ["ts", "conversation_id", "request_id", "query", "response", "followups", "chunk_ids", "distances",
+                "timings", "route", "classified_route", "route_reason", "snapshot", "error"]
+# Columns holding lists or dicts, stored as JSON text in SQLite
+JSON_COLUMNS = {"followups", "chunk_ids", "distances", "timings"}
+
+class SqliteTurnStore:
+    def __init__(self, path: str):
+        # Writes happen on worker threads, one batch at a time
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS turns (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "ts REAL, conversation_id TEXT, request_id TEXT, query TEXT, response TEXT, followups TEXT, "
+            "chunk_ids TEXT, distances TEXT, timings TEXT, route TEXT, classified_route TEXT, route_reason TEXT, "
+            "snapshot TEXT, error TEXT)"
+        )
+        # Databases created before a column existed get it added, empty for earlier turns
+        existing = {row[1] for row in self.connection.execute("PRAGMA table_info(turns)")}
+        for column in TURN_COLUMNS:
+            if column not in existing:
+                self.connection.execute(f"ALTER TABLE turns ADD COLUMN {column} TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS turns_conversation ON turns (conversation_id)")
+        self.connection.commit()
+
+    def write(self, batch: List[Dict]):
+        rows = [
+            [json.dumps(turn.get(c)) if c in JSON_COLUMNS else turn.get(c) for c in TURN_COLUMNS]
+            for turn in batch
+        ]
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT INTO turns ({', '.join(TURN_COLUMNS)}) VALUES ({', '.join('?' * len(TURN_COLUMNS))})", rows
+            )
+
+    def close(self):
+        self.connection.close()
+
+class JsonlTurnStore:
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, batch: List[Dict]):
+        # Each batch is appended as its own gzip member; readers see one continuous stream
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            for turn in batch:
+                f.write(json.dumps(turn) + "\n")
+
+    def close(self):
+        pass
+
+class ConversationLogger:
+    """
+    Write-behind log of chat turns. log_turn only enqueues, so it never waits on disk;
+    a background task writes turns in batches and drops them when the queue is full.
+    """
+
+    def __init__(self, store, max_queue_size: int = MAX_QUEUE_SIZE, batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL):
+        self.store = store
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = {"enqueued": 0, "written": 0, "dropped": 0, "write_errors": 0}
+        self.task: Optional[asyncio.Task] = None
+
+    def log_turn(self, turn: Dict) -> bool:
+        turn.setdefault("ts", time.time())
+        try:
+            self.queue.put_nowait(turn)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            return False
+        self.stats["enqueued"] += 1
+        return True
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            turn = await self.queue.get()
+            if turn is None:
+                return
+            batch = [turn]
+            stopping = False
+            # Give a burst a moment to accumulate so it is written as one batch
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    turn = await asyncio.wait_for(self.queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if turn is None:
+                    stopping = True
+                    break
+                batch.append(turn)
+            await self.flush(batch)
+            if stopping:
+                return
+
+    async def flush(self, batch: List[Dict]):
+        try:
+            await asyncio.to_thread(self.store.write, batch)
+            self.stats["written"] += len(batch)
+        except Exception as e:
+            self.stats["write_errors"] += 1
+            self.stats["dropped"] += len(batch)
+            logger.error(f"Failed to write {len(batch)} conversation turns: {e}")
+
+    async def close(self):
+        """Writes whatever is still queued, then stops the background task."""
+        if self.task is not None:
+            # The sentinel is queued behind pending turns, so the writer drains them first
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+        self.store.close()
+
+def create_conversation_logger() -> Optional[ConversationLogger]:
+    if CONVERSATION_LOG == "off":
+        return None
+    if CONVERSATION_LOG == "jsonl":
+        return ConversationLogger(JsonlTurnStore(CONVERSATION_LOG_PATH))
+    return ConversationLogger(SqliteTurnStore(CONVERSATION_LOG_PATH))
@@ -0,0 +1,176 @@
+import os
+import json
+import asyncio
+import logging
+import faiss
+import numpy as np
+from typing import Dict, List, Optional
+from groq import AsyncGroq
+from dotenv import load_dotenv
+from lexical import HASH_DIM, hash_embed
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+questions_file_path = "followup_questions.jsonl"
+followup_index_path = "followup_index.faiss"
+
+# Number of nearest neighbours considered before MMR picks the final questions
+CANDIDATE_POOL = 20
+# Trade-off between relevance (1.0) and diversity (0.0)
+MMR_LAMBDA = 0.7
+# Candidates this similar to the current query are just rephrasings of it
+# ("When should I water tomatoes?" scores about 0.78 against "How often should I water tomatoes?")
+DUPLICATE_THRESHOLD = 0.7
+# Candidates less relevant than this are left out, even if fewer than k questions remain
+MIN_RELEVANCE = 0.15
+# The same thresholds for banks indexed with the sentence encoder, whose cosines run much higher
+# than hashed bag-of-words ones, even between loosely related questions
+ENCODER_DUPLICATE_THRESHOLD = 0.85
+ENCODER_MIN_RELEVANCE = 0.35
+
+QUESTION_PROMPT = (
+    "Write {n} short questions a gardener could ask that are answered by the passage below. "
+    "Return one question per line with no numbering.\n\nPassage:\n{chunk}"
+)
+
+async def _generate_chunk_questions(client: AsyncGroq, chunk: str, semaphore: asyncio.Semaphore, per_chunk: int) -> List[str]:
+    async with semaphore:
+        try:
+            completion = await client.chat.completions.create(
+                model="llama3-70b-8192",
+                messages=[{"role": "user", "content": QUESTION_PROMPT.format(n=per_chunk, chunk=chunk)}],
+                temperature=0.3,
+                max_tokens=200
+            )
+            # A chunk without usable questions must not fail the whole ingestion run
+            content = completion.choices[0].message.content or ""
+        except Exception as e:
+            logger.error(f"Error generating follow-up questions for chunk: {e}")
+            return []
+    lines = [line.strip().lstrip("-*0123456789. ").strip() for line in content.split("\n")]
+    return [line for line in lines if line.endswith("?")][:per_chunk]
+
+async def build_question_bank(chunks: List[str], per_chunk: int = 3, concurrency: int = 4,
+                              questions_file: str = questions_file_path, index_file: str = followup_index_path,
+                              encoder=None) -> int:
+    """
+    Generates follow-up questions for every chunk and saves them with their own FAISS index.
+    Meant to run once at ingestion time, alongside the chunk index. The questions are embedded with
+    `encoder` (the chunk encoder) when given, otherwise with hashed bag-of-words vectors.
+    """
+    client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*[
+        _generate_chunk_questions(client, chunk, semaphore, per_chunk) for chunk in chunks
+    ])
+
+    questions = []
+    seen = set()
+    for chunk_id, chunk_questions in enumerate(results):
+        for question in chunk_questions:
+            key = question.lower()
+            if key not in seen:
+                seen.add(key)
+                questions.append({"question": question, "chunk_id": chunk_id})
+
+    with open(questions_file, "w", encoding="utf-8") as f:
+        for entry in questions:
+            f.write(json.dumps(entry) + "\n")
+
+    texts = [entry["question"] for entry in questions]
+    embeddings = hash_embed(texts) if encoder is None else np.asarray(encoder.encode(texts), dtype=np.float32)
+    index = faiss.IndexFlatIP(embeddings.shape[1])
+    index.add(embeddings)
+    faiss.write_index(index, index_file)
+
+    logger.info(f"Saved {len(questions)} follow-up questions from {len(chunks)} chunks")
+    return len(questions)
+
+class FollowupEngine:
+    """
+    Picks follow-up questions from a precomputed question bank, without an LLM call.
+    Banks indexed with the sentence encoder need that encoder at query time; banks indexed with
+    hashed bag-of-words vectors (dimension HASH_DIM) need no model at all.
+    """
+
+    def __init__(self, index: faiss.Index, questions: List[Dict], encoder=None):
+        self.index = index
+        self.questions = questions
+        self.encoder = encoder
+
+    @classmethod
+    def load(cls, questions_file: str = questions_file_path, index_file: str = followup_index_path,
+             encoder=None) -> "FollowupEngine":
+        with open(questions_file, "r", encoding="utf-8") as f:
+            questions = [json.loads(line) for line in f if line.strip()]
+        index = faiss.read_index(index_file)
+        if index.ntotal != len(questions):
+            raise ValueError(f"Follow-up index has {index.ntotal} vectors but {len(questions)} questions")
+        if index.d == HASH_DIM:
+            return cls(index, questions)
+        if encoder is None:
+            raise ValueError(f"Follow-up index has dimension {index.d} and needs the sentence encoder, which is not loaded")
+        dimension = np.asarray(encoder.encode(["probe"])).shape[1]
+        if dimension != index.d:
+            raise ValueError(f"Follow-up index has dimension {index.d} but the encoder produces {dimension}")
+        return cls(index, questions, encoder)
+
+    def suggest(self, query: str, answer: str = "", history: Optional[List[Dict[str, str]]] = None, k: int = 3,
+                query_embedding: Optional[np.ndarray] = None) -> List[str]:
+        """`query_embedding` is the encoder vector retrieval already computed for the query, if any."""
+        if self.index.ntotal == 0:
+            return []
+
+        if self.encoder is None:
+            query_vec, answer_vec = hash_embed([query, answer])
+            duplicate_threshold, min_relevance = DUPLICATE_THRESHOLD, MIN_RELEVANCE
+        else:
+            if query_embedding is None:
+                query_embedding = self.encoder.encode([query])
+            query_vec = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+            answer_vec = (np.asarray(self.encoder.encode([answer]), dtype=np.float32)[0] if answer.strip()
+                          else np.zeros_like(query_vec))
+            duplicate_threshold, min_relevance = ENCODER_DUPLICATE_THRESHOLD, ENCODER_MIN_RELEVANCE
+        # Blend query and answer so suggestions follow on from what was actually said
+        target = query_vec + answer_vec
+        norm = np.linalg.norm(target)
+        if norm == 0:
+            return []
+        target = (target / norm).reshape(1, -1)
+
+        scores, ids = self.index.search(target, min(CANDIDATE_POOL, self.index.ntotal))
+
+        asked = {m["content"].strip().lower() for m in (history or []) if m.get("role") == "user"}
+        asked.add(query.strip().lower())
+
+        candidate_ids = []
+        for i in ids[0]:
+            if i < 0:
+                continue
+            if self.questions[i]["question"].strip().lower() in asked:
+                continue
+            candidate_ids.append(int(i))
+        if not candidate_ids:
+            return []
+
+        candidates = np.vstack([self.index.reconstruct(i) for i in candidate_ids])
+        relevance = candidates @ target[0]
+        query_similarity = candidates @ query_vec
+        pairwise = candidates @ candidates.T
+
+        selected: List[int] = []
+        remaining = [j for j in range(len(candidate_ids))
+                     if relevance[j] >= min_relevance and query_similarity[j] < duplicate_threshold]
+        while remaining and len(selected) < k:
+            best, best_score = None, -np.inf
+            for j in remaining:
+                redundancy = max(pairwise[j, s] for s in selected) if selected else 0.0
+                score = MMR_LAMBDA * relevance[j] - (1 - MMR_LAMBDA) * redundancy
+                if score > best_score:
+                    best, best_score = j, score
+            selected.append(best)
+            remaining.remove(best)
+
+        return [self.questions[candidate_ids[j]]["question"] for j in selected]
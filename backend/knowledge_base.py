@@ -0,0 +1,194 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+import faiss
+import numpy as np
+from dataclasses import dataclass
+from typing import List, Optional
+from followup_engine import FollowupEngine
+from metadata_filter import MetadataIndex
+from updated_rag_without_sentence_transfromers import load_text_chunks
+
+logger = logging.getLogger(__name__)
+
+# Published knowledge base versions live in SNAPSHOT_DIR/<version>/, and SNAPSHOT_DIR/CURRENT names the live one
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+CURRENT_FILE = "CURRENT"
+LEGACY_VERSION = "legacy"
+
+INDEX_FILE = "index_file.faiss"
+CHUNKS_FILE = "text_chunks.txt"
+EMBEDDINGS_FILE = "precomputed_embeddings.npy"
+QUESTIONS_FILE = "followup_questions.jsonl"
+FOLLOWUP_INDEX_FILE = "followup_index.faiss"
+METADATA_FILE = "chunk_metadata.jsonl"
+SNAPSHOT_FILES = [INDEX_FILE, CHUNKS_FILE, EMBEDDINGS_FILE, QUESTIONS_FILE, FOLLOWUP_INDEX_FILE, METADATA_FILE]
+
+# Number of stored vectors searched for during validation
+PROBE_COUNT = 5
+
+# Largest squared L2 distance between normalised embeddings for a chunk to count as relevant;
+# shared by the server and batch runs so both retrieve the same context
+RELEVANCE_MAX_DISTANCE = float(os.getenv("RELEVANCE_MAX_DISTANCE", "1.0"))
+
+@dataclass
+class Snapshot:
+    """One immutable version of the FAISS index, its chunks, their metadata and the follow-up question bank."""
+    version: str
+    index: faiss.Index
+    chunks: List[str]
+    embeddings: Optional[np.ndarray] = None
+    followup_engine: Optional[FollowupEngine] = None
+    metadata: Optional[MetadataIndex] = None
+
+def load_snapshot(directory: str, version: str, encoder=None) -> Snapshot:
+    index = faiss.read_index(os.path.join(directory, INDEX_FILE))
+    chunks = load_text_chunks(os.path.join(directory, CHUNKS_FILE))
+
+    embeddings_path = os.path.join(directory, EMBEDDINGS_FILE)
+    embeddings = np.load(embeddings_path) if os.path.exists(embeddings_path) else None
+
+    # The follow-up question bank is optional; without it follow-ups fall back to the LLM
+    try:
+        followup_engine = FollowupEngine.load(os.path.join(directory, QUESTIONS_FILE),
+                                              os.path.join(directory, FOLLOWUP_INDEX_FILE), encoder)
+    except Exception as e:
+        logger.warning(f"Follow-up question bank unavailable for snapshot {version}, using LLM follow-ups: {e}")
+        followup_engine = None
+
+    # Without chunk metadata the snapshot still serves unfiltered queries
+    metadata_path = os.path.join(directory, METADATA_FILE)
+    metadata = MetadataIndex.load(metadata_path) if os.path.exists(metadata_path) else None
+
+    return Snapshot(version, index, chunks, embeddings, followup_engine, metadata)
+
+def validate_snapshot(snapshot: Snapshot, previous: Optional[Snapshot] = None) -> None:
+    """Raises ValueError if the snapshot is inconsistent or fails its probe queries."""
+    if snapshot.index.ntotal == 0:
+        raise ValueError("index is empty")
+    if snapshot.index.ntotal != len(snapshot.chunks):
+        raise ValueError(f"index has {snapshot.index.ntotal} vectors but there are {len(snapshot.chunks)} chunks")
+    if snapshot.embeddings is None:
+        raise ValueError(f"{EMBEDDINGS_FILE} is missing")
+    if snapshot.embeddings.shape != (snapshot.index.ntotal, snapshot.index.d):
+        raise ValueError(f"embeddings have shape {snapshot.embeddings.shape}, "
+                         f"expected ({snapshot.index.ntotal}, {snapshot.index.d})")
+    if snapshot.metadata is not None and snapshot.metadata.size != len(snapshot.chunks):
+        raise ValueError(f"metadata has {snapshot.metadata.size} entries but there are {len(snapshot.chunks)} chunks")
+    if previous is not None and snapshot.index.d != previous.index.d:
+        raise ValueError(f"index dimension {snapshot.index.d} does not match live dimension {previous.index.d}")
+
+    # Each probe is a stored vector, so a healthy index returns it as its own nearest neighbour
+    probe_ids = np.linspace(0, snapshot.index.ntotal - 1, num=min(PROBE_COUNT, snapshot.index.ntotal), dtype=np.int64)
+    probes = np.vstack([snapshot.index.reconstruct(int(i)) for i in probe_ids])
+    distances, _ = snapshot.index.search(probes, 1)
+    for probe_id, distance in zip(probe_ids, distances[:, 0]):
+        if distance > 1e-3:
+            raise ValueError(f"probe for vector {probe_id} returned distance {distance:.4f}")
+
+def read_current_version(snapshot_dir: str = SNAPSHOT_DIR) -> Optional[str]:
+    try:
+        with open(os.path.join(snapshot_dir, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def load_current_snapshot(snapshot_dir: str = SNAPSHOT_DIR, legacy_dir: str = ".", encoder=None) -> Snapshot:
+    """Loads the version CURRENT points at, or the legacy files when nothing has been published."""
+    version = read_current_version(snapshot_dir)
+    if version is None:
+        # Deployments that predate snapshots keep their files next to main.py
+        return load_snapshot(legacy_dir, LEGACY_VERSION, encoder)
+    return load_snapshot(os.path.join(snapshot_dir, version), version, encoder)
+
+def publish_snapshot(source_dir: str = ".", snapshot_dir: str = SNAPSHOT_DIR, version: Optional[str] = None) -> str:
+    """
+    Copies freshly generated files into a new version directory and points CURRENT at it.
+    Running servers pick it up through the watcher or the reload endpoint.
+    """
+    version = version or time.strftime("%Y%m%d-%H%M%S")
+    target = os.path.join(snapshot_dir, version)
+    os.makedirs(target, exist_ok=False)
+    for name in SNAPSHOT_FILES:
+        path = os.path.join(source_dir, name)
+        if os.path.exists(path):
+            shutil.copy2(path, os.path.join(target, name))
+
+    # os.replace is atomic, so readers never see a half-written CURRENT
+    tmp_path = os.path.join(snapshot_dir, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(snapshot_dir, CURRENT_FILE))
+    logger.info(f"Published knowledge base snapshot {version}")
+    return version
+
+class KnowledgeBase:
+    """
+    Holds the live snapshot and swaps it for a new version without a restart.
+    Callers read `current` once per request and use that snapshot throughout, so in-flight
+    queries finish on the version they started with and the old one is freed afterwards.
+    """
+
+    def __init__(self, snapshot_dir: str = SNAPSHOT_DIR, legacy_dir: str = ".", encoder=None):
+        self.snapshot_dir = snapshot_dir
+        self.legacy_dir = legacy_dir
+        # Query encoder, needed by follow-up question banks indexed with it
+        self.encoder = encoder
+        self.reload_lock = asyncio.Lock()
+        self.failed_version: Optional[str] = None
+        self.watch_task: Optional[asyncio.Task] = None
+        self.current = load_current_snapshot(snapshot_dir, legacy_dir, encoder)
+        validate_snapshot(self.current)
+        logger.info(f"Loaded knowledge base snapshot {self.current.version}")
+
+    async def reload(self, version: Optional[str] = None) -> str:
+        async with self.reload_lock:
+            version = version or read_current_version(self.snapshot_dir)
+            if version is None:
+                raise ValueError("no published snapshot to load")
+            if version in (".", "..") or os.path.basename(version) != version:
+                raise ValueError(f"invalid snapshot version {version!r}")
+            if version == self.current.version:
+                return version
+
+            # Load and validate off the event loop so queries keep being served meanwhile
+            snapshot = await asyncio.to_thread(load_snapshot, os.path.join(self.snapshot_dir, version), version,
+                                               self.encoder)
+            await asyncio.to_thread(validate_snapshot, snapshot, self.current)
+
+            previous = self.current.version
+            self.current = snapshot
+            logger.info(f"Switched knowledge base snapshot {previous} -> {version}")
+            return version
+
+    def start_watching(self, interval: float):
+        # Keep a reference: the event loop only holds tasks weakly
+        if self.watch_task is None:
+            self.watch_task = asyncio.create_task(self.watch(interval))
+            self.watch_task.add_done_callback(self._watcher_done)
+
+    @staticmethod
+    def _watcher_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Knowledge base watcher stopped, new snapshots will not be picked up: {task.exception()!r}")
+
+    async def stop_watching(self):
+        if self.watch_task is not None:
+            self.watch_task.cancel()
+            await asyncio.gather(self.watch_task, return_exceptions=True)
+            self.watch_task = None
+
+    async def watch(self, interval: float):
+        """Polls CURRENT and reloads whenever a new version is published."""
+        while True:
+            await asyncio.sleep(interval)
+            version = read_current_version(self.snapshot_dir)
+            if version is None or version in (self.current.version, self.failed_version):
+                continue
+            try:
+                await self.reload(version)
+            except Exception as e:
+                self.failed_version = version
+                logger.error(f"Failed to load knowledge base snapshot {version}, keeping {self.current.version}: {e}")
@@ -0,0 +1,53 @@
+import re
+import zlib
+import numpy as np
+from typing import List
+
+# Dimension of the hashed bag-of-words vectors
+HASH_DIM = 2048
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from",
+    "how", "i", "in", "is", "it", "its", "my", "of", "on", "or", "should", "that", "the",
+    "their", "this", "to", "what", "when", "which", "why", "with", "you", "your",
+}
+
+def tokenize(text: str) -> List[str]:
+    """Lowercases text and returns word tokens without stopwords."""
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+def features(text: str) -> List[str]:
+    """Unigram and bigram features of a text, as used by hash_embed."""
+    tokens = tokenize(text)
+    return tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+def coverage(query: str, texts: List[str]) -> np.ndarray:
+    """
+    Fraction of the query's features found in each text. Unlike cosine similarity it does not
+    shrink as a text gets longer, so it shows whether a sentence contains what was asked about.
+    """
+    wanted = set(features(query))
+    if not wanted:
+        return np.zeros(len(texts), dtype=np.float32)
+    return np.array([len(wanted.intersection(features(text))) / len(wanted) for text in texts], dtype=np.float32)
+
+def _bucket(feature: str, dim: int) -> int:
+    # crc32 is stable across processes, unlike the salted built-in hash()
+    return zlib.crc32(feature.encode("utf-8")) % dim
+
+def hash_embed(texts: List[str], dim: int = HASH_DIM) -> np.ndarray:
+    """
+    Embeds texts as L2-normalised hashed unigram/bigram vectors.
+    Cheap enough to run per query without a model or a network call.
+    """
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for feature in features(text):
+            vectors[row, _bucket(feature, dim)] += 1.0
+    # Sublinear term frequency, then unit length so inner product is cosine similarity
+    np.log1p(vectors, out=vectors)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
@@ -1,13 +1,21 @@
 import os
+import json
+import time
+import uuid
 import asyncio
 import logging
-import faiss
-import numpy as np
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, List, Tuple
-from analyze_plant_image import analyze_plant_image
-from updated_rag_without_sentence_transfromers import custom_query_with_groq, load_faiss_index, load_text_chunks
+from fastapi.responses import StreamingResponse
+from starlette.websockets import WebSocketState
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from groq import APITimeoutError
+from analyze_plant_image import analyze_plant_image, analyze_plant_images
+from conversation_log import create_conversation_logger
+from knowledge_base import RELEVANCE_MAX_DISTANCE, KnowledgeBase
+from metadata_filter import filtered_search
+from onnx_encoder import OnnxEncoder
+from updated_rag_without_sentence_transfromers import custom_query_with_groq
 
 # Initialize FastAPI app
 app = FastAPI()
@@ -25,24 +33,44 @@ app.add_middleware(
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Clients that request this subprotocol get typed JSON frames; all others get the legacy plain-text reply
+PROTOCOL_V1 = "plantapp.v1"
+HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20"))  # seconds
+
 # WebSocket connection manager
 class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
         self.conversation_history: Dict[WebSocket, List[Dict[str, str]]] = {}
+        self.protocols: Dict[WebSocket, Optional[str]] = {}
+        self.send_locks: Dict[WebSocket, asyncio.Lock] = {}
+        self.conversation_ids: Dict[WebSocket, str] = {}
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
+    async def connect(self, websocket: WebSocket) -> Optional[str]:
+        protocol = PROTOCOL_V1 if PROTOCOL_V1 in websocket.scope.get("subprotocols", []) else None
+        await websocket.accept(subprotocol=protocol)
         self.active_connections.append(websocket)
         self.conversation_history[websocket] = []
+        self.protocols[websocket] = protocol
+        self.send_locks[websocket] = asyncio.Lock()
+        self.conversation_ids[websocket] = uuid.uuid4().hex
+        return protocol
 
     def disconnect(self, websocket: WebSocket):
         self.active_connections.remove(websocket)
         if websocket in self.conversation_history:
             del self.conversation_history[websocket]
+        self.protocols.pop(websocket, None)
+        self.send_locks.pop(websocket, None)
+        self.conversation_ids.pop(websocket, None)
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+        # Heartbeats are sent from another task, so frames must not interleave
+        async with self.send_locks[websocket]:
+            await websocket.send_text(message)
+
+    async def send_frame(self, frame: Dict, websocket: WebSocket):
+        await self.send_personal_message(json.dumps({"v": 1, **frame}), websocket)
 
     def add_to_history(self, websocket: WebSocket, role: str, content: str):
         if websocket not in self.conversation_history:
@@ -61,67 +89,292 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
-# Load FAISS index and text chunks at startup
-index_file_path = "index_file.faiss"
-chunks_file_path = "text_chunks.txt"
-query_embedding_path = "query_embedding.npy"
+# Queries are embedded with the ONNX encoder (see onnx_encoder.py export). Without the exported
+# model, retrieval falls back to searching with the first stored chunk and metadata filters are ignored
+try:
+    query_encoder: Optional[OnnxEncoder] = OnnxEncoder()
+except Exception as e:
+    logger.warning(f"Query encoder unavailable, retrieval will not use the query or filters: {e}")
+    query_encoder = None
+
+# Load the live knowledge base snapshot at startup; new versions are swapped in without a restart
+INDEX_WATCH_INTERVAL = float(os.getenv("INDEX_WATCH_INTERVAL", "30"))  # seconds, 0 disables the watcher
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
 try:
-    index = load_faiss_index(index_file_path)
-    all_chunks = load_text_chunks(chunks_file_path)
+    # The encoder is shared with follow-up question banks that were indexed with it
+    knowledge_base = KnowledgeBase(encoder=query_encoder)
 except Exception as e:
     logger.error(f"Failed to load FAISS index or text chunks: {e}")
     raise
 
-async def handle_query(query: str, history: List[Dict[str, str]] = None) -> Tuple[str, List[str]]:
+# Upper bound on the time one chat request may spend, including every upstream LLM call
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "60"))  # seconds
+
+# Outcome counters for chat requests, exposed on /metrics
+request_metrics: Dict[str, int] = {"requests": 0, "completed": 0, "errors": 0, "timed_out": 0, "cancelled": 0}
+
+# Turns are persisted by a background writer so logging never delays a reply
+conversation_logger = create_conversation_logger()
+
+@app.on_event("startup")
+async def start_index_watcher():
+    if INDEX_WATCH_INTERVAL > 0:
+        knowledge_base.start_watching(INDEX_WATCH_INTERVAL)
+
+@app.on_event("shutdown")
+async def stop_index_watcher():
+    await knowledge_base.stop_watching()
+
+@app.on_event("startup")
+async def start_conversation_logger():
+    if conversation_logger is not None:
+        conversation_logger.start()
+
+@app.on_event("shutdown")
+async def stop_conversation_logger():
+    if conversation_logger is not None:
+        await conversation_logger.close()
+
+def record_turn(conversation_id: Optional[str], request_id: Optional[str], query: str, response: str,
+                followups: List[str], trace: Dict):
+    if conversation_logger is None:
+        return
+    sources = trace.get("sources", [])
+    conversation_logger.log_turn({
+        "conversation_id": conversation_id,
+        "request_id": request_id,
+        "query": query,
+        "response": response,
+        "followups": followups,
+        "chunk_ids": [source["chunk_id"] for source in sources],
+        "distances": [source["distance"] for source in sources],
+        "timings": trace.get("timings", {}),
+        "route": trace.get("route"),
+        "classified_route": trace.get("classified_route"),
+        "route_reason": trace.get("route_reason"),
+        "snapshot": trace.get("snapshot"),
+        "error": trace.get("error"),
+    })
+
+async def handle_query(query: str, history: List[Dict[str, str]] = None,
+                       on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+                       trace: Optional[Dict] = None,
+                       filters: Optional[Dict[str, List[str]]] = None,
+                       timeout: float = REQUEST_TIMEOUT) -> Tuple[str, List[str]]:
+    if trace is None:
+        trace = {}
+    timings = trace.setdefault("timings", {})
+    started = time.perf_counter()
+    # The deadline is passed down so every upstream call only gets the time that is left
+    deadline = time.monotonic() + timeout
+    request_metrics["requests"] += 1
     try:
-        # Load all precomputed embeddings
-        embeddings = np.load("precomputed_embeddings.npy")
+        # Pin one snapshot for the whole request so a reload cannot change it midway
+        snapshot = knowledge_base.current
         
-        # Get index for first embedding only
-        first_embedding = embeddings[0].reshape(1, -1)
-        indices, distances = index.search(first_embedding, 5)
+        encoded_query = None
+        if query_encoder is not None:
+            query_embedding = encoded_query = await asyncio.to_thread(query_encoder.encode, [query])
+        else:
+            # Filtering a fixed vector would not reflect the query, so only the unfiltered fallback is kept
+            if filters:
+                logger.warning("Ignoring metadata filters because the query encoder is unavailable")
+            query_embedding = snapshot.embeddings[0].reshape(1, -1)
+            filters = None
+        distances, indices = filtered_search(snapshot.index, query_embedding, 5, snapshot.metadata, filters)
         
         # Select relevant chunks
-        relevance_threshold = 0.5
-        top_chunks = []
-        if distances[0][0] <= relevance_threshold:
-            # Convert float indices to integers
-            indices_int = indices[0].astype(int)
-            top_chunks = [all_chunks[i] for i in indices_int if i < len(all_chunks)]
+        top_ids = []
+        if distances[0][0] <= RELEVANCE_MAX_DISTANCE:
+            top_ids = [int(i) for i in indices[0] if 0 <= i < len(snapshot.chunks)]
+        top_chunks = [snapshot.chunks[i] for i in top_ids]
+        trace["snapshot"] = snapshot.version
+        trace["sources"] = [
+            {"chunk_id": int(i), "distance": float(d),
+             **(snapshot.metadata.metadata[i] if snapshot.metadata is not None else {})}
+            for i, d in zip(indices[0], distances[0]) if int(i) in top_ids
+        ]
+        timings["retrieval_ms"] = round((time.perf_counter() - started) * 1000, 1)
         
-        response, followups = await custom_query_with_groq(query, top_chunks, history)
+        response, followups = await asyncio.wait_for(
+            custom_query_with_groq(query, top_chunks, history, snapshot.followup_engine, top_ids,
+                                   on_delta, trace, deadline, encoded_query),
+            timeout=max(0.0, deadline - time.monotonic())
+        )
+        request_metrics["completed"] += 1
         return response, followups
         
+    except asyncio.CancelledError:
+        # The client went away; the upstream call has already been torn down with this task
+        request_metrics["cancelled"] += 1
+        trace["error"] = "cancelled"
+        raise
+    except WebSocketDisconnect:
+        # Streaming a delta failed because the client left, which is a cancellation rather than a server error
+        request_metrics["cancelled"] += 1
+        trace["error"] = "cancelled"
+        raise
+    except (asyncio.TimeoutError, APITimeoutError):
+        logger.warning(f"Query timed out after {timeout:g}s")
+        request_metrics["timed_out"] += 1
+        trace["error"] = "timeout"
+        return "The request took too long to answer. Please try again.", []
     except Exception as e:
+        request_metrics["errors"] += 1
         logger.error(f"Error handling query: {str(e)}")
         logger.exception("Full traceback:")
+        trace["error"] = str(e)
         return "An error occurred while processing your query.", []
+    finally:
+        timings["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+async def send_heartbeats(websocket: WebSocket):
+    """Lets structured clients detect a dead server; uvicorn's protocol pings reap dead clients."""
+    try:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            await manager.send_frame({"type": "heartbeat", "ts": time.time()}, websocket)
+    except Exception:
+        # The receive loop notices the disconnect and cleans up
+        return
+
+async def handle_structured_message(websocket: WebSocket, data: str):
+    try:
+        message = json.loads(data)
+    except json.JSONDecodeError:
+        # Tolerate plain text from structured clients
+        message = {"type": "query", "text": data}
+    if not isinstance(message, dict):
+        message = {"type": "query", "text": str(message)}
+
+    request_id = str(message.get("id") or uuid.uuid4().hex)
+    if message.get("type") == "ping":
+        await manager.send_frame({"type": "pong", "id": request_id}, websocket)
+        return
+    query = str(message.get("text") or "").strip()
+    if message.get("type") != "query" or not query:
+        await manager.send_frame({"type": "error", "id": request_id, "message": "Expected a query frame with text"}, websocket)
+        return
+
+    manager.add_to_history(websocket, "user", query)
+    history = manager.get_history(websocket)
+
+    async def on_delta(text: str):
+        await manager.send_frame({"type": "delta", "id": request_id, "text": text}, websocket)
+
+    # Read up front: a cancelled request is recorded after the connection may already be gone
+    conversation_id = manager.conversation_ids.get(websocket)
+    trace: Dict = {}
+    response, followups = "", []
+    try:
+        response, followups = await handle_query(query, history, on_delta, trace, message.get("filters"))
+    except Exception as e:
+        trace.setdefault("error", str(e))
+        raise
+    finally:
+        # Cancelled and failed requests are logged too, with whatever was produced before they stopped
+        record_turn(conversation_id, request_id, query, response, followups, trace)
+    if "error" in trace:
+        await manager.send_frame({"type": "error", "id": request_id, "message": response}, websocket)
+    else:
+        manager.add_to_history(websocket, "assistant", response)
+        await manager.send_frame({"type": "answer", "id": request_id, "text": response}, websocket)
+        await manager.send_frame({"type": "followups", "id": request_id, "questions": followups}, websocket)
+        await manager.send_frame({"type": "sources", "id": request_id, "chunks": trace.get("sources", []),
+                                  "snapshot": trace.get("snapshot")}, websocket)
+    await manager.send_frame({"type": "timing", "id": request_id, **trace["timings"]}, websocket)
+
+async def handle_legacy_message(websocket: WebSocket, data: str):
+    manager.add_to_history(websocket, "user", data)
+    
+    history = manager.get_history(websocket)
+    conversation_id = manager.conversation_ids.get(websocket)
+    trace: Dict = {}
+    response, followups = "", []
+    try:
+        response, followups = await handle_query(data, history, trace=trace)
+    except Exception as e:
+        trace.setdefault("error", str(e))
+        raise
+    finally:
+        record_turn(conversation_id, None, data, response, followups, trace)
+    
+    manager.add_to_history(websocket, "assistant", response)
+    
+    if followups:
+        combined_response = f"{response}\n\nFollow-up questions:\n" + "\n".join([f"- {q}" for q in followups])
+    else:
+        combined_response = response
+        
+    await manager.send_personal_message(combined_response, websocket)
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+    protocol = await manager.connect(websocket)
+    heartbeat = asyncio.create_task(send_heartbeats(websocket)) if protocol == PROTOCOL_V1 else None
+    handler = handle_structured_message if protocol == PROTOCOL_V1 else handle_legacy_message
+
+    # Keep reading while a request runs so a disconnect is noticed at once and cancels it
+    incoming: asyncio.Queue = asyncio.Queue()
+    current: Optional[asyncio.Task] = None
+
+    async def receive_messages():
+        try:
+            while True:
+                await incoming.put(await websocket.receive_text())
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            # e.g. a binary frame makes receive_text raise KeyError; close like an unhandled error would
+            logger.error(f"Error receiving message: {e}")
+            if websocket.application_state == WebSocketState.CONNECTED:
+                await websocket.close(code=1011)
+        finally:
+            # However the reader exits, stop the in-flight request and end the endpoint loop
+            if current is not None and not current.done():
+                current.cancel()
+            incoming.put_nowait(None)
+
+    receiver = asyncio.create_task(receive_messages())
     try:
-        while True:
-            data = await websocket.receive_text()
-            manager.add_to_history(websocket, "user", data)
-            
-            history = manager.get_history(websocket)
-            response, followups = await handle_query(data, history)
-            
-            manager.add_to_history(websocket, "assistant", response)
-            
-            if followups:
-                combined_response = f"{response}\n\nFollow-up questions:\n" + "\n".join([f"- {q}" for q in followups])
-            else:
-                combined_response = response
-                
-            await manager.send_personal_message(combined_response, websocket)
-            
-    except WebSocketDisconnect:
+        while (data := await incoming.get()) is not None:
+            current = asyncio.create_task(handler(websocket, data))
+            await asyncio.wait({current})
+            # A failed send means the client is gone just as surely as a cancelled request does
+            if current.cancelled() or isinstance(current.exception(), WebSocketDisconnect):
+                logger.info("Cancelled in-flight request after client disconnected")
+                break
+            if current.exception() is not None:
+                logger.error(f"Error processing message: {current.exception()}")
+    finally:
+        receiver.cancel()
+        if current is not None and not current.done():
+            current.cancel()
+        if heartbeat is not None:
+            heartbeat.cancel()
         manager.disconnect(websocket)
         logging.info("Client disconnected")
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        **request_metrics,
+        "active_connections": len(manager.active_connections),
+        "conversation_log": conversation_logger.stats if conversation_logger is not None else None,
+    }
+
+@app.post("/admin/reload-index")
+async def reload_index(version: Optional[str] = None, x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    try:
+        loaded = await knowledge_base.reload(version)
+    except Exception as e:
+        logger.error(f"Error reloading index: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"version": loaded}
+
 @app.post("/upload-image")
 async def upload_image(file: UploadFile = File(...)):
     try:
@@ -132,6 +385,31 @@ async def upload_image(file: UploadFile = File(...)):
         logger.error(f"Error analyzing image: {e}")
         return {"error": str(e)}
 
+# Each image costs a vision call, so one request may not upload an unbounded number of them
+MAX_UPLOAD_IMAGES = int(os.getenv("MAX_UPLOAD_IMAGES", "10"))
+
+@app.post("/upload-images")
+async def upload_images(files: List[UploadFile] = File(...), mode: str = "fanout"):
+    """Streams newline-delimited JSON events: each image's analysis as it completes, then the merged summary."""
+    if len(files) > MAX_UPLOAD_IMAGES:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_UPLOAD_IMAGES} images can be uploaded at once")
+    images = [await file.read() for file in files]
+    filenames = [file.filename for file in files]
+
+    async def events():
+        try:
+            async for event in analyze_plant_images(images, mode):
+                if "index" in event:
+                    event["filename"] = filenames[event["index"]]
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            logger.error(f"Error analyzing images: {e}")
+            yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # permessage-deflate compresses large answers; protocol pings close connections whose client went away
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws="websockets", ws_per_message_deflate=True,
+                ws_ping_interval=20.0, ws_ping_timeout=20.0)
\ No newline at end of file
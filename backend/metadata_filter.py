@@ -0,0 +1,92 @@
+import json
+import faiss
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+metadata_file_path = "chunk_metadata.jsonl"
+
+# Filterable fields and the metadata key each one reads
+FILTER_FIELDS = {"source": "source", "page": "page", "tag": "tags"}
+
+def save_chunk_metadata(metadata: List[Dict], file_path: str = metadata_file_path) -> None:
+    with open(file_path, "w", encoding="utf-8") as f:
+        for entry in metadata:
+            f.write(json.dumps(entry) + "\n")
+
+def load_chunk_metadata(file_path: str = metadata_file_path) -> List[Dict]:
+    with open(file_path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _values(entry: Dict, key: str) -> List[str]:
+    value = entry.get(key)
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(v) for v in value]
+    return [str(value)]
+
+class MetadataIndex:
+    """
+    Inverted index from each metadata value to a packed bitmap of the chunk IDs that carry it.
+    Bitmaps use FAISS's little-endian bit order, so a combined filter is passed straight to
+    IDSelectorBitmap and the search skips excluded IDs instead of post-filtering the top-k.
+    """
+
+    def __init__(self, metadata: List[Dict]):
+        self.metadata = metadata
+        self.size = len(metadata)
+        self.num_bytes = (self.size + 7) // 8
+        self.bitmaps: Dict[Tuple[str, str], np.ndarray] = {}
+
+        members: Dict[Tuple[str, str], List[int]] = {}
+        for chunk_id, entry in enumerate(metadata):
+            for field, key in FILTER_FIELDS.items():
+                for value in _values(entry, key):
+                    members.setdefault((field, value), []).append(chunk_id)
+        for term, ids in members.items():
+            bits = np.zeros(self.size, dtype=bool)
+            bits[ids] = True
+            self.bitmaps[term] = np.packbits(bits, bitorder="little")
+
+    @classmethod
+    def load(cls, file_path: str = metadata_file_path) -> "MetadataIndex":
+        return cls(load_chunk_metadata(file_path))
+
+    def values(self, field: str) -> List[str]:
+        return sorted(value for f, value in self.bitmaps if f == field)
+
+    def bitmap(self, filters: Dict[str, List[str]]) -> np.ndarray:
+        """
+        Combines filters such as {"source": ["tomato_guide.pdf"], "tag": ["uk"]}:
+        values within a field are OR-ed and fields are AND-ed.
+        """
+        result = np.full(self.num_bytes, 0xFF, dtype=np.uint8)
+        for field, values in filters.items():
+            if field not in FILTER_FIELDS:
+                raise ValueError(f"Unknown filter field {field!r}")
+            if isinstance(values, str):
+                values = [values]
+            field_bits = np.zeros(self.num_bytes, dtype=np.uint8)
+            for value in values:
+                term_bits = self.bitmaps.get((field, str(value)))
+                if term_bits is not None:
+                    np.bitwise_or(field_bits, term_bits, out=field_bits)
+            np.bitwise_and(result, field_bits, out=result)
+        return result
+
+def filtered_search(index: faiss.Index, query_embedding: np.ndarray, k: int,
+                    metadata_index: Optional[MetadataIndex] = None,
+                    filters: Optional[Dict[str, List[str]]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Searches the index, restricted to chunks matching the filters when any are given."""
+    if not filters:
+        return index.search(query_embedding, k)
+    if metadata_index is None:
+        raise ValueError("This knowledge base has no chunk metadata to filter on")
+
+    bitmap = metadata_index.bitmap(filters)
+    if not bitmap.any():
+        return (np.full((len(query_embedding), k), np.inf, dtype=np.float32),
+                np.full((len(query_embedding), k), -1, dtype=np.int64))
+    selector = faiss.IDSelectorBitmap(bitmap)
+    # The selector only references the bitmap, which stays alive in this frame until the search returns
+    return index.search(query_embedding, k, params=faiss.SearchParameters(sel=selector))
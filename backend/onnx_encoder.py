@@ -0,0 +1,165 @@
+import os
+import sys
+import time
+import argparse
+import logging
+import resource
+import numpy as np
+from typing import List
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "onnx_model")
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))  # 0 lets ONNX Runtime pick
+# all-mpnet-base-v2 truncates inputs at 384 tokens
+MAX_SEQ_LENGTH = 384
+
+class OnnxEncoder:
+    """
+    Runs all-mpnet-base-v2 with ONNX Runtime instead of PyTorch.
+    Mirrors SentenceTransformer.encode: mean pooling over tokens, then L2 normalisation.
+    """
+
+    def __init__(self, model_dir: str = ONNX_MODEL_DIR, threads: int = ONNX_THREADS, quantized: bool = True):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        model_file = "model_int8.onnx" if quantized else "model.onnx"
+        self.session = ort.InferenceSession(os.path.join(model_dir, model_file), options,
+                                            providers=["CPUExecutionProvider"])
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding()
+
+    def encode(self, sentences: List[str], batch_size: int = 32) -> np.ndarray:
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        outputs = []
+        for start in range(0, len(sentences), batch_size):
+            encodings = self.tokenizer.encode_batch(sentences[start:start + batch_size])
+            input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            token_embeddings = self.session.run(None, {"input_ids": input_ids, "attention_mask": attention_mask})[0]
+
+            mask = attention_mask[..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            outputs.append(pooled.astype(np.float32))
+        if not outputs:
+            return np.zeros((0, 768), dtype=np.float32)
+        return np.vstack(outputs)
+
+def export_onnx_model(model_dir: str = ONNX_MODEL_DIR) -> None:
+    """Exports the PyTorch encoder to ONNX and writes an int8 dynamically quantized copy."""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    os.makedirs(model_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    model = AutoModel.from_pretrained(MODEL_NAME)
+    model.eval()
+    tokenizer.save_pretrained(model_dir)
+
+    sample = tokenizer(["How often should I water tomatoes?"], return_tensors="pt")
+    fp32_path = os.path.join(model_dir, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample["input_ids"], sample["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+            },
+            opset_version=17,
+        )
+    quantize_dynamic(fp32_path, os.path.join(model_dir, "model_int8.onnx"), weight_type=QuantType.QInt8)
+    logger.info(f"Exported ONNX encoder to {model_dir}")
+
+def load_sample_texts(chunks_file: str = "text_chunks.txt") -> List[str]:
+    from updated_rag_without_sentence_transfromers import load_text_chunks
+    return load_text_chunks(chunks_file)
+
+def check_parity(model_dir: str = ONNX_MODEL_DIR, min_cosine: float = 0.98) -> bool:
+    """Compares ONNX embeddings with the PyTorch SentenceTransformer embeddings of the stored chunks."""
+    from sentence_transformers import SentenceTransformer
+
+    texts = load_sample_texts()
+    reference = SentenceTransformer("all-mpnet-base-v2").encode(texts, normalize_embeddings=True)
+    candidate = OnnxEncoder(model_dir).encode(texts)
+    cosine = (reference * candidate).sum(axis=1)
+
+    # Retrieval only cares that rankings survive quantization
+    ref_top = np.argsort(-(reference @ reference.T), axis=1)[:, :5]
+    cand_top = np.argsort(-(candidate @ reference.T), axis=1)[:, :5]
+    overlap = np.mean([len(set(a) & set(b)) / 5 for a, b in zip(ref_top, cand_top)])
+
+    logger.info(f"Cosine vs PyTorch: min {cosine.min():.4f}, mean {cosine.mean():.4f}; top-5 overlap {overlap:.3f}")
+    return bool(cosine.min() >= min_cosine)
+
+def benchmark(backend: str, model_dir: str = ONNX_MODEL_DIR, batch_size: int = 32, rounds: int = 3) -> None:
+    """Reports encode throughput, single-query latency and peak RSS for one backend."""
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    load_started = time.perf_counter()
+    if backend == "onnx":
+        encoder = OnnxEncoder(model_dir)
+    else:
+        from sentence_transformers import SentenceTransformer
+        encoder = SentenceTransformer("all-mpnet-base-v2", device="cpu")
+    load_seconds = time.perf_counter() - load_started
+
+    texts = load_sample_texts()
+    encoder.encode(texts[:batch_size], batch_size=batch_size)  # warm-up
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        encoder.encode(texts, batch_size=batch_size)
+    throughput = rounds * len(texts) / (time.perf_counter() - started)
+
+    latencies = []
+    for text in texts:
+        query = text[:120]
+        t = time.perf_counter()
+        encoder.encode([query])
+        latencies.append((time.perf_counter() - t) * 1000)
+
+    # ru_maxrss is kilobytes on Linux
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    logger.info(
+        f"{backend}: load {load_seconds:.2f}s, {throughput:.1f} chunks/s, "
+        f"query p50 {np.percentile(latencies, 50):.1f}ms p95 {np.percentile(latencies, 95):.1f}ms, "
+        f"peak RSS {rss_mb:.0f}MB (before load {rss_before / 1024:.0f}MB)"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Export, verify and benchmark the ONNX encoder.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("export")
+    subparsers.add_parser("parity")
+    bench = subparsers.add_parser("bench")
+    bench.add_argument("--backend", choices=["onnx", "torch"], default="onnx")
+    bench.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_onnx_model()
+    elif args.command == "parity":
+        sys.exit(0 if check_parity() else 1)
+    else:
+        # Run each backend in its own process so peak RSS is not shared
+        benchmark(args.backend, batch_size=args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import os
+import re
+import logging
+import numpy as np
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+from lexical import coverage, tokenize
+from context_builder import split_sentences
+
+logger = logging.getLogger(__name__)
+
+# "off" always uses the large model, "shadow" logs the route it would take but still uses
+# the large model, "on" follows the route
+ROUTER_MODE = os.getenv("ROUTER_MODE", "shadow")
+# Queries with at most this many content words are candidates for the small model
+SMALL_MAX_WORDS = int(os.getenv("ROUTER_SMALL_MAX_WORDS", "8"))
+# A context sentence holding at least this share of the query's words and word pairs is returned
+# directly without an LLM call. On the gardening guide, lookups such as "What is drip irrigation?"
+# score 1.0 and "characteristics of clay soil" 0.8, while "How often should I water tomatoes?"
+# scores 0.6 against "Water tomatoes deeply once a week." because nothing answers "how often"
+RETRIEVAL_COVERAGE = float(os.getenv("ROUTER_RETRIEVAL_COVERAGE", "0.75"))
+# Single-word queries are contained in too many sentences by chance to be answered that way
+RETRIEVAL_MIN_WORDS = 2
+RETRIEVAL_ANSWER_SENTENCES = 3
+
+LARGE_MODEL = "llama3-70b-8192"
+SMALL_MODEL = "llama-3.1-8b-instant"
+
+GREETING = re.compile(r"^\s*(hi|hello|hey|thanks|thank you|good (morning|afternoon|evening)|bye|ok(ay)?)\b[\s!.?]*$", re.IGNORECASE)
+# Wording that usually needs reasoning over several facts rather than a lookup
+COMPLEX_CUES = {"why", "compare", "difference", "explain", "plan", "schedule", "diagnose", "versus", "vs", "best", "should"}
+
+@dataclass
+class Route:
+    name: str  # "retrieval", "small" or "large"
+    model: str
+    max_tokens: int
+    reason: str
+
+LARGE_ROUTE = Route("large", LARGE_MODEL, 1000, "default")
+
+def classify_query(query: str, context: str) -> Route:
+    """Chooses the cheapest route likely to answer the query well."""
+    if GREETING.match(query):
+        return Route("small", SMALL_MODEL, 150, "greeting")
+
+    words = re.findall(r"[a-z0-9]+", query.lower())
+    content_words = tokenize(query)
+    is_complex = bool(COMPLEX_CUES.intersection(words)) or query.count("?") > 1
+
+    sentences = split_sentences(context) if context else []
+    if sentences and not is_complex and len(content_words) >= RETRIEVAL_MIN_WORDS:
+        best = float(np.max(coverage(query, sentences)))
+        if best >= RETRIEVAL_COVERAGE:
+            return Route("retrieval", "", 0, f"query coverage {best:.2f}")
+
+    if len(content_words) <= SMALL_MAX_WORDS and not is_complex:
+        return Route("small", SMALL_MODEL, 400, f"{len(content_words)} content words")
+
+    return Route("large", LARGE_MODEL, 1000, "complex query" if is_complex else "long query")
+
+def choose_route(query: str, context: str) -> Tuple[Route, Optional[Route]]:
+    """Returns the route to take and the one the classifier picked, which differ in shadow mode."""
+    if ROUTER_MODE == "off":
+        return LARGE_ROUTE, None
+    route = classify_query(query, context)
+    if ROUTER_MODE == "shadow":
+        logger.info(f"Router (shadow) would choose {route.name} ({route.reason}); using large")
+        return LARGE_ROUTE, route
+    logger.info(f"Router chose {route.name} ({route.reason})")
+    return route, route
+
+def retrieval_answer(query: str, context: str) -> str:
+    """Answers from the context sentences that cover the query, best first up to a few of them."""
+    sentences: List[str] = split_sentences(context)
+    scores = coverage(query, sentences)
+    best = np.argsort(-scores, kind="stable")[:RETRIEVAL_ANSWER_SENTENCES]
+    top = sorted(i for i in best if scores[i] >= RETRIEVAL_COVERAGE)
+    return " ".join(sentences[i] for i in top)
@@ -1,13 +1,16 @@
 import os
+import json
 import asyncio
 from groq import AsyncGroq
 from PyPDF2 import PdfReader
-from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
 import logging
 from typing import Dict, List, Tuple
 from dotenv import load_dotenv
+from followup_engine import build_question_bank
+from knowledge_base import publish_snapshot
+from metadata_filter import save_chunk_metadata
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
@@ -18,21 +21,46 @@ load_dotenv()
 client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
 
 # Initialize global variables
-embedding_model = SentenceTransformer("all-mpnet-base-v2")
+# "torch" runs the encoder through sentence-transformers, "onnx" through the quantized ONNX export
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+if EMBEDDING_BACKEND == "onnx":
+    from onnx_encoder import OnnxEncoder
+    embedding_model = OnnxEncoder()
+else:
+    from sentence_transformers import SentenceTransformer
+    embedding_model = SentenceTransformer("all-mpnet-base-v2")
 index = None
 all_chunks = []
 
 def process_pdf(pdf_path: str, chunk_size: int = 500) -> List[str]:
+    chunks, _ = process_pdf_with_metadata(pdf_path, chunk_size)
+    return chunks
+
+def process_pdf_with_metadata(pdf_path: str, chunk_size: int = 500, tags: List[str] = None) -> Tuple[List[str], List[Dict]]:
+    """Chunks a PDF and records the source file, starting page and tags of every chunk."""
     reader = PdfReader(pdf_path)
     all_text = ""
+    page_starts = []
     
-    for page in reader.pages:
+    for page_number, page in enumerate(reader.pages, start=1):
         text = page.extract_text()
         if text:
+            page_starts.append((len(all_text), page_number))
             all_text += text + "\n"
 
-    chunks = [all_text[i:i + chunk_size] for i in range(0, len(all_text), chunk_size)]
-    return chunks
+    chunks = []
+    metadata = []
+    page_index = 0
+    for i in range(0, len(all_text), chunk_size):
+        while page_index + 1 < len(page_starts) and page_starts[page_index + 1][0] <= i:
+            page_index += 1
+        chunks.append(all_text[i:i + chunk_size])
+        metadata.append({
+            "source": os.path.basename(pdf_path),
+            "page": page_starts[page_index][1],
+            "tags": list(tags or []),
+        })
+    return chunks, metadata
 
 def generate_embeddings(chunks: List[str]) -> np.ndarray:
     return np.array(embedding_model.encode(chunks))
@@ -62,24 +90,41 @@ async def preprocess_and_save():
     try:
         # Process PDFs and get chunks
         pdf_dir = "./document"
+        # Optional {"file.pdf": ["tomato", "region:uk"]} mapping used for filtered retrieval
+        tags_path = os.path.join(pdf_dir, "tags.json")
+        document_tags = {}
+        if os.path.exists(tags_path):
+            with open(tags_path, "r", encoding="utf-8") as f:
+                document_tags = json.load(f)
+
         all_chunks = []
-        for filename in os.listdir(pdf_dir):
+        all_metadata = []
+        for filename in sorted(os.listdir(pdf_dir)):
             if filename.endswith(".pdf"):
                 pdf_path = os.path.join(pdf_dir, filename)
-                chunks = process_pdf(pdf_path)
+                chunks, metadata = process_pdf_with_metadata(pdf_path, tags=document_tags.get(filename, []))
                 all_chunks.extend(chunks)
+                all_metadata.extend(metadata)
 
         # Save chunks to file
         with open("text_chunks.txt", "w", encoding="utf-8") as f:
             for chunk in all_chunks:
                 f.write(chunk + "\n---\n")  # Add separator between chunks
 
+        save_chunk_metadata(all_metadata)
+
         # Generate and save embeddings
         embeddings = save_query_embeddings_batch(all_chunks)
         
         # Create and save FAISS index
         index = create_faiss_index(embeddings)
         save_faiss_index(index, "index_file.faiss")
+
+        # Build the follow-up question bank used to suggest questions without an LLM call
+        await build_question_bank(all_chunks, encoder=embedding_model)
+
+        # Version the generated files so running servers can swap them in without a restart
+        publish_snapshot()
         
         logger.info("Successfully saved all preprocessing files")
         
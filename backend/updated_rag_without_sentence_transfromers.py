@@ -1,11 +1,15 @@
 import os
+import time
 import asyncio
-from groq import AsyncGroq
+from groq import AsyncGroq, NOT_GIVEN
 import faiss
 import numpy as np
 import logging
-from typing import Dict, List, Tuple
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
+from followup_engine import FollowupEngine
+from context_builder import build_context, estimate_tokens, trim_history
+from query_router import choose_route, retrieval_answer
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
@@ -15,6 +19,9 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
 
+# "local" picks follow-ups from the precomputed question bank, "llm" asks the model
+FOLLOWUP_MODE = os.getenv("FOLLOWUP_MODE", "local")
+
 # Global variables
 index = None
 all_chunks = []
@@ -25,45 +32,129 @@ def load_faiss_index(file_path: str) -> faiss.IndexFlatL2:
 
 # Load text chunks from a saved file
 def load_text_chunks(file_path: str) -> List[str]:
+    # Chunks are kept exactly as sliced, whitespace included, so that merging adjacent
+    # chunks restores the original text instead of gluing words together
     with open(file_path, "r", encoding="utf-8") as file:
-        return [chunk.strip() for chunk in file.read().split("\n---\n") if chunk.strip()]
+        return [chunk for chunk in file.read().split("\n---\n") if chunk.strip()]
+
+def remaining_timeout(deadline: Optional[float]):
+    """Seconds left before a time.monotonic() deadline, for per-call upstream timeouts."""
+    if deadline is None:
+        # Keep the client's default timeout rather than disabling it
+        return NOT_GIVEN
+    return max(0.1, deadline - time.monotonic())
+
+async def generate_followups_with_groq(query: str, response: str, deadline: Optional[float] = None) -> List[str]:
+    followup_prompt = (
+        f"The user asked '{query}' and was answered:\n{response}\n\n"
+        "Suggest 3 relevant follow-up questions, one per line."
+    )
+    followup_completion = await client.chat.completions.create(
+        model="llama3-70b-8192",
+        messages=[{"role": "user", "content": followup_prompt}],
+        temperature=0.7,
+        max_tokens=150,
+        timeout=remaining_timeout(deadline)
+    )
+    followups = [q.strip() for q in followup_completion.choices[0].message.content.split("\n") if q.strip()]
+    return followups[:3]
 
-async def custom_query_with_groq(query: str, relevant_chunks: List[str], history: List[Dict[str, str]] = None) -> Tuple[str, List[str]]:
+async def custom_query_with_groq(query: str, relevant_chunks: List[str], history: List[Dict[str, str]] = None,
+                                 followup_engine: Optional[FollowupEngine] = None,
+                                 chunk_ids: Optional[List[int]] = None,
+                                 on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+                                 trace: Optional[Dict] = None,
+                                 deadline: Optional[float] = None,
+                                 query_embedding: Optional[np.ndarray] = None) -> Tuple[str, List[str]]:
     try:
         if history is None:
             history = []
+        if trace is None:
+            trace = {}
+        timings = trace.setdefault("timings", {})
+        if chunk_ids is None:
+            # Without IDs adjacency is unknown, so keep every chunk separate
+            chunk_ids = list(range(0, 2 * len(relevant_chunks), 2))
         
-        context = "\n".join(relevant_chunks) if relevant_chunks else ""
+        context, stats = build_context(query, list(zip(chunk_ids, relevant_chunks)))
+        trimmed_history = trim_history(history)
         
-        messages = history.copy()
-        messages.append({
-            "role": "system",
-            "content": f"You are a helpful assistant. Use this context to inform your response:\n{context}"
-        })
-        messages.append({
-            "role": "user",
-            "content": query
-        })
-        
-        completion = await client.chat.completions.create(
-            model="llama3-70b-8192",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1000
+        history_tokens_before = sum(estimate_tokens(m["content"]) for m in history)
+        history_tokens_after = sum(estimate_tokens(m["content"]) for m in trimmed_history)
+        logger.info(
+            f"Prompt tokens: {stats.tokens_before + history_tokens_before} -> {stats.tokens_after + history_tokens_after} "
+            f"(context {stats.tokens_before} -> {stats.tokens_after}, history {history_tokens_before} -> {history_tokens_after}, "
+            f"sentences {stats.sentences_before} -> {stats.sentences_after})"
         )
         
-        response = completion.choices[0].message.content
-        
-        followup_prompt = f"Based on the conversation history and current query '{query}', suggest 3 relevant follow-up questions."
-        followup_completion = await client.chat.completions.create(
-            model="llama3-70b-8192",
-            messages=[{"role": "user", "content": followup_prompt}],
-            temperature=0.7,
-            max_tokens=150
-        )
+        route, classified = choose_route(query, context)
+        trace["route"] = route.name
+        if classified is not None:
+            # In shadow mode the route taken is always large; the classified one is what measures savings
+            trace["classified_route"] = classified.name
+            trace["route_reason"] = classified.reason
+        trace["prompt_tokens"] = stats.tokens_after + history_tokens_after
+        started = time.perf_counter()
+        if route.name == "retrieval":
+            response = retrieval_answer(query, context)
+            if on_delta is not None:
+                await on_delta(response)
+        else:
+            messages = trimmed_history.copy()
+            messages.append({
+                "role": "system",
+                "content": f"You are a helpful assistant. Use this context to inform your response:\n{context}"
+            })
+            messages.append({
+                "role": "user",
+                "content": query
+            })
+            
+            if on_delta is not None:
+                # Stream so the caller can forward tokens as they arrive
+                stream = await client.chat.completions.create(
+                    model=route.model,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=route.max_tokens,
+                    stream=True,
+                    timeout=remaining_timeout(deadline)
+                )
+                response = ""
+                try:
+                    async for chunk in stream:
+                        delta_content = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta_content:
+                            response += delta_content
+                            await on_delta(delta_content)
+                finally:
+                    # Closing the stream on cancellation stops upstream generation instead of draining it
+                    await stream.close()
+                logger.info(f"Streamed completion on {route.model}: {(time.perf_counter() - started) * 1000:.0f}ms")
+            else:
+                completion = await client.chat.completions.create(
+                    model=route.model,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=route.max_tokens,
+                    timeout=remaining_timeout(deadline)
+                )
+                usage = completion.usage
+                logger.info(
+                    f"Completion on {route.model}: {(time.perf_counter() - started) * 1000:.0f}ms, "
+                    f"{usage.prompt_tokens if usage else '?'} prompt + {usage.completion_tokens if usage else '?'} completion tokens"
+                )
+                
+                response = completion.choices[0].message.content
+        timings["llm_ms"] = round((time.perf_counter() - started) * 1000, 1)
         
-        followups = [q.strip() for q in followup_completion.choices[0].message.content.split("\n") if q.strip()]
-        return response, followups[:3]
+        started = time.perf_counter()
+        if FOLLOWUP_MODE == "local" and followup_engine is not None:
+            followups = followup_engine.suggest(query, response, history, query_embedding=query_embedding)
+        else:
+            followups = await generate_followups_with_groq(query, response, deadline)
+        timings["followups_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return response, followups
         
     except Exception as e:
         logger.error(f"Error in custom_query_with_groq: {e}")
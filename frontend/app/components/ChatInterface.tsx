@@ -18,8 +18,21 @@ interface Message {
   imageUrl?: string;
   isTyping?: boolean;
   displayedContent?: string;
+  followups?: string[];
 }
 
+// Typed frames sent by the backend when the plantapp.v1 subprotocol is negotiated
+type ServerFrame =
+  | { v: 1; type: 'delta'; id: string; text: string }
+  | { v: 1; type: 'answer'; id: string; text: string }
+  | { v: 1; type: 'followups'; id: string; questions: string[] }
+  | { v: 1; type: 'sources'; id: string; snapshot?: string; chunks: { chunk_id: number; distance: number; source?: string; page?: number; tags?: string[] }[] }
+  | { v: 1; type: 'error'; id?: string; message: string }
+  | { v: 1; type: 'timing'; id: string; [stage: string]: unknown }
+  | { v: 1; type: 'heartbeat' | 'pong'; [key: string]: unknown };
+
+const WS_PROTOCOL = 'plantapp.v1';
+
 export function ChatInterface() {
   const [messages, setMessages] = useState<Message[]>([{
     id: '1',
@@ -67,22 +80,79 @@ export function ChatInterface() {
   }, []); // Initial greeting animation
 
   useEffect(() => {
-    const websocket = new WebSocket('ws://52.207.245.139:8000/ws');
+    const websocket = new WebSocket('ws://52.207.245.139:8000/ws', WS_PROTOCOL);
+
+    const updateReply = (requestId: string, update: (msg: Message) => Message) => {
+      const messageId = `reply-${requestId}`;
+      setMessages(prev => {
+        const existing = prev.find(msg => msg.id === messageId);
+        const base: Message = existing ?? {
+          id: messageId,
+          content: '',
+          type: 'text',
+          sender: 'other',
+          isTyping: true,
+          displayedContent: ''
+        };
+        const updated = update(base);
+        return existing
+          ? prev.map(msg => (msg.id === messageId ? updated : msg))
+          : [...prev, updated];
+      });
+    };
+
+    const handleFrame = (frame: ServerFrame) => {
+      switch (frame.type) {
+        case 'delta':
+          updateReply(frame.id, msg => ({
+            ...msg,
+            content: msg.content + frame.text,
+            displayedContent: (msg.displayedContent || '') + frame.text,
+            isTyping: true
+          }));
+          break;
+        case 'answer':
+          updateReply(frame.id, msg => ({
+            ...msg,
+            content: frame.text,
+            displayedContent: frame.text,
+            isTyping: false
+          }));
+          break;
+        case 'followups':
+          updateReply(frame.id, msg => ({ ...msg, followups: frame.questions }));
+          break;
+        case 'error': {
+          if (frame.id) {
+            // Replace any partial streamed reply so it stops showing as typing
+            updateReply(frame.id, msg => ({
+              ...msg,
+              content: frame.message,
+              displayedContent: frame.message,
+              isTyping: false
+            }));
+            break;
+          }
+          const messageId = Date.now().toString();
+          setMessages(prev => [...prev, {
+            id: messageId,
+            content: frame.message,
+            type: 'text',
+            sender: 'other',
+            isTyping: false,
+            displayedContent: frame.message
+          }]);
+          break;
+        }
+        default:
+          // heartbeat, pong, sources and timing frames need no UI
+          break;
+      }
+    };
     
+    // The handshake fails unless the server selects WS_PROTOCOL, so every message is a typed frame
     websocket.onmessage = (event) => {
-      const response = event.data;
-      const messageId = Date.now().toString();
-      
-      setMessages(prev => [...prev, {
-        id: messageId,
-        content: response,
-        type: 'text',
-        sender: 'other',
-        isTyping: true,
-        displayedContent: ''
-      }]);
-
-      simulateTyping(response, messageId);
+      handleFrame(JSON.parse(event.data) as ServerFrame);
     };
 
     setWs(websocket);
@@ -92,20 +162,24 @@ export function ChatInterface() {
     };
   }, []);
 
+  const sendQuery = (text: string) => {
+    const requestId = Date.now().toString();
+    const newMessage: Message = {
+      id: requestId,
+      content: text,
+      type: 'text',
+      sender: 'user',
+    };
+    setMessages(prev => [...prev, newMessage]);
+    
+    if (ws && ws.readyState === WebSocket.OPEN) {
+      ws.send(JSON.stringify({ type: 'query', id: requestId, text }));
+    }
+  };
+
   const handleSendMessage = () => {
     if (inputMessage.trim()) {
-      const newMessage: Message = {
-        id: Date.now().toString(),
-        content: inputMessage,
-        type: 'text',
-        sender: 'user',
-      };
-      setMessages(prev => [...prev, newMessage]);
-      
-      if (ws && ws.readyState === WebSocket.OPEN) {
-        ws.send(inputMessage);
-      }
-      
+      sendQuery(inputMessage);
       setInputMessage('');
     }
   };
@@ -206,6 +280,19 @@ export function ChatInterface() {
                     }
                   </p>
                 )}
+                {message.followups && message.followups.length > 0 && (
+                  <div className="mt-2 flex flex-col gap-1">
+                    {message.followups.map((question) => (
+                      <button
+                        key={question}
+                        className="text-left text-sm underline underline-offset-2 opacity-80 hover:opacity-100"
+                        onClick={() => sendQuery(question)}
+                      >
+                        {question}
+                      </button>
+                    ))}
+                  </div>
+                )}
                 {message.type === 'image' && message.imageUrl && (
                   <img src={message.imageUrl} alt="Uploaded plant" className="max-w-full rounded" />
                 )}